@@ -1,12 +1,22 @@
 #! /usr/bin/env python3
+from concurrent.futures import as_completed, ThreadPoolExecutor
 from extract_manylinux.download import Downloader
 from extract_manylinux.extract import Arch
 from pathlib import Path
 
 
-for arch in (Arch.AARCH64, Arch.I686, Arch.X86_64):
-    dowloader = Downloader(
-        image = f"manylinux2014_{arch}"
-    )
-    destination = Path(f'images/2014/{arch}')
-    dowloader.download(destination)
+ARCHS = (Arch.AARCH64, Arch.I686, Arch.X86_64)
+
+
+def _dl(arch):
+    with Downloader(image = f"manylinux2014_{arch}") as dowloader:
+        destination = Path(f'images/2014/{arch}')
+        dowloader.download(destination)
+
+
+# Each architecture is downloaded to a distinct destination, thus downloads can
+# run concurrently.
+with ThreadPoolExecutor(max_workers=len(ARCHS)) as executor:
+    futures = [executor.submit(_dl, arch) for arch in ARCHS]
+    for future in as_completed(futures):
+        future.result()
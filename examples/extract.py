@@ -1,9 +1,14 @@
 #! /usr/bin/env python3
+from concurrent.futures import as_completed, ProcessPoolExecutor
 from extract_manylinux.extract import Arch, Extractor
 from pathlib import Path
 from shutil import make_archive
 
-for arch in (Arch.AARCH64, Arch.I686, Arch.X86_64):
+
+ARCHS = (Arch.AARCH64, Arch.I686, Arch.X86_64)
+
+
+def _ex(arch):
     extractor = Extractor(
         arch=arch,
         prefix=Path(f'images/2014/{arch}'),
@@ -13,3 +18,12 @@ for arch in (Arch.AARCH64, Arch.I686, Arch.X86_64):
     extractor.extract(destination)
     make_archive(str(destination), 'gztar', destination.parent,
                  destination.name)
+
+
+if __name__ == '__main__':
+    # Each architecture is extracted to a distinct destination, thus
+    # extractions can run concurrently.
+    with ProcessPoolExecutor(max_workers=len(ARCHS)) as executor:
+        futures = [executor.submit(_ex, arch) for arch in ARCHS]
+        for future in as_completed(futures):
+            future.result()
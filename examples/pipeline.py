@@ -0,0 +1,62 @@
+#! /usr/bin/env python3
+from concurrent.futures import ThreadPoolExecutor
+from extract_manylinux.download import Downloader
+from extract_manylinux.extract import Arch, Extractor
+from pathlib import Path
+import queue
+from shutil import make_archive
+
+
+ARCHS = (Arch.AARCH64, Arch.I686, Arch.X86_64)
+
+
+def _dl(arch, ready):
+    try:
+        with Downloader(image = f"manylinux2014_{arch}") as dowloader:
+            destination = Path(f'images/2014/{arch}')
+            dowloader.download(destination)
+    except Exception as e:
+        ready.put((arch, e))
+        raise
+    else:
+        ready.put((arch, None))
+
+
+def _ex(arch):
+    extractor = Extractor(
+        arch=arch,
+        prefix=Path(f'images/2014/{arch}'),
+        tag='cp311-cp311'
+    )
+    destination = Path(f'extracted/python3.11-2014_{arch}')
+    extractor.extract(destination)
+    make_archive(str(destination), 'gztar', destination.parent,
+                 destination.name)
+
+
+# Downloads (producers) and extractions (consumers) are pipelined through a
+# queue. Thus, an image is extracted as soon as it has been downloaded, while
+# other images are still being fetched.
+ready = queue.Queue()
+downloaders = ThreadPoolExecutor(max_workers=len(ARCHS))
+extractors = ThreadPoolExecutor(max_workers=len(ARCHS))
+for arch in ARCHS:
+    downloaders.submit(_dl, arch, ready)
+
+extractions = []
+for _ in ARCHS:
+    arch, error = ready.get()
+    if error is not None:
+        break
+    extractions.append(extractors.submit(_ex, arch))
+
+# In case of error, pending tasks are cancelled and the error is reported
+# without waiting for running ones.
+wait = error is None
+downloaders.shutdown(wait=wait, cancel_futures=not wait)
+extractors.shutdown(wait=wait, cancel_futures=not wait)
+if error is not None:
+    raise error
+
+for extraction in extractions:
+    extraction.result()
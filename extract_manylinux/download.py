@@ -1,15 +1,20 @@
-import collections
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 import hashlib
+import os
 from pathlib import Path
 import requests
+import shutil
 import subprocess
 import tempfile
-import time
-from typing import List, Optional
+import threading
+from typing import IO, List, Optional
 
 
-CHUNK_SIZE = 8189
+CHUNK_SIZE = 1 << 20
+
+MAX_WORKERS = 8
 
 SUCCESS = 200
 
@@ -21,28 +26,91 @@ class TarError(Exception):
     pass
 
 
+def _sha256(path: Path) -> str:
+    '''Compute the SHA-256 hash of a file.'''
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
 @dataclass(frozen=True)
 class Downloader:
 
     '''Manylinux image.'''
     image: str
 
+    '''Cache for downloaded layers (disabled if None).'''
+    cache_dir: Optional[Path] = field(
+        default_factory=lambda: Path('~/.cache/extract-manylinux').expanduser()
+    )
+
     '''Authentication token.'''
     token: str = field(init=False)
 
+    '''HTTP sessions (reusing connections), one per thread.'''
+    sessions: List[requests.Session] = field(init=False, repr=False,
+                                             compare=False)
+
+    '''Per-thread HTTP session.'''
+    _local: threading.local = field(init=False, repr=False, compare=False)
+
+    '''Guards sessions.'''
+    _lock: threading.Lock = field(init=False, repr=False, compare=False)
+
 
     def __post_init__(self):
+        object.__setattr__(self, 'sessions', [])
+        object.__setattr__(self, '_local', threading.local())
+        object.__setattr__(self, '_lock', threading.Lock())
+
         # Authenticate to quay.io.
         repository = f'pypa/{self.image}'
         url = 'https://quay.io/v2/auth'
         url = f'{url}?service=quay.io&scope=repository:{repository}:pull'
-        r = requests.request('GET', url)
+        r = self.session().get(url)
         if r.status_code == SUCCESS:
             object.__setattr__(self, 'token', r.json()['token'])
         else:
             raise DownloadError(r.status_code, r.text, r.headers)
 
 
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def close(self):
+        '''Close all HTTP sessions.'''
+        with self._lock:
+            for session in self.sessions:
+                session.close()
+            self.sessions.clear()
+            object.__setattr__(self, '_local', threading.local())
+
+
+    def session(self) -> requests.Session:
+        '''Get the HTTP session of the current thread.
+
+           Since requests sessions are not guaranteed to be thread-safe, a
+           distinct session is used by each thread.
+        '''
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            self._local.session = session
+            with self._lock:
+                self.sessions.append(session)
+        return session
+
+
     def download(self, destination=None, tag='latest'):
         destination = destination or self.image
 
@@ -53,116 +121,226 @@ class Downloader:
             'Authorization': f'Bearer {self.token}',
             'Accept': 'application/vnd.docker.distribution.manifest.v2+json'
         }
-        r = requests.request('GET', url, headers=headers)
+        r = self.session().get(url, headers=headers)
         if r.status_code == SUCCESS:
             manifest = r.json()
         else:
             raise DownloadError(r.status_code, r.text, r.headers)
 
-        # Fetch layers using a producer / consumer pattern for extracting
-        # tarfiles in parallel (using a subprocess).
-        tarfiles = collections.deque()
+        # Fetch layers concurrently, using a pool of threads. Layers are
+        # extracted (using a subprocess) as soon as they have been fetched.
+        # Note that layers must be extracted in order (overlay semantics).
         workdir = None
+        extracted = 0
+        workers = set()
+
+        def fetch_layer(index, layer):
+            session = self.session()
+            with self._lock:
+                workers.add(session)
+
+            digest = layer['digest']
+            hash_ = digest.split(':', 1)[-1]
+            filename = f'{hash_}.tar.gz'
+
+            # Check for a cached layer. Since layers are content addressed,
+            # they can be shared between images.
+            if self.cache_dir is not None:
+                cached = self.cache_dir / filename
+                if cached.exists():
+                    if _sha256(cached) == hash_:
+                        print(f'using cached {filename}')
+                        return cached, False
+                    else:
+                        cached.unlink(missing_ok=True)
+
+            url = f'https://quay.io/v2/{repository}/blobs/{digest}'
+            r = session.get(url, headers=headers, stream=True)
+            if r.status_code == SUCCESS:
+                print(f'fetching {filename}')
+            else:
+                raise DownloadError(r.status_code, r.text, r.headers)
 
-        def fetch_layers():
-            for layer in manifest['layers']:
-                digest = layer['digest']
-                hash_ = digest.split(':', 1)[-1]
-                filename = f'{hash_}.tar.gz'
-                url = f'https://quay.io/v2/{repository}/blobs/{digest}'
-                r = requests.request('GET', url, headers=headers, stream=True)
-                if r.status_code == SUCCESS:
-                    print(f'fetching {filename}')
-                else:
-                    raise DownloadError(r.status_code, r.text, r.headers)
+            # If all previous layers have already been extracted, then the
+            # layer is directly streamed to tar. Otherwise, it is written to a
+            # file, for later extraction. Layers to be cached are written to a
+            # file in any case.
+            stream = (index == extracted)
+            if self.cache_dir is not None:
+                # Download to a temporary file, which is moved to the cache
+                # once it has been verified.
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                fd, path = tempfile.mkstemp(suffix='.part', dir=self.cache_dir)
+                os.close(fd)
+                path = Path(path)
+            elif stream:
+                path = None
+            else:
+                path = workdir / filename
 
+            extractor = None
+            try:
                 hasher = hashlib.sha256()
-                with open(workdir / filename, "wb") as f:
-                    for chunk in r.iter_content(CHUNK_SIZE): 
-                        if chunk:
+                if stream:
+                    extractor = TarExtractor(
+                        filename = None,
+                        destination = destination
+                    )
+                    print(f'extracting {filename}')
+                with contextlib.ExitStack() as stack:
+                    if path is None:
+                        f = None
+                    else:
+                        f = stack.enter_context(open(path, "wb"))
+                    for chunk in r.iter_content(CHUNK_SIZE):
+                        if f is not None:
                             f.write(chunk)
-                            hasher.update(chunk)
-                            yield
+                        if extractor is not None:
+                            extractor.write(chunk)
+                        hasher.update(chunk)
+                if extractor is not None:
+                    extractor.extract()
 
                 h = hasher.hexdigest()
                 if h != hash_:
                     raise DownloadError(
-                        f'bad hash (expected {name}, found {h})'
+                        f'bad hash (expected {hash_}, found {h})'
                     )
-                else:
-                    tarfiles.append(filename)
-                    yield
+            except BaseException as e:
+                if path is not None:
+                    path.unlink(missing_ok=True)
+                if extractor is not None:
+                    extractor.abort()
+                    if isinstance(e, Exception):
+                        # The layer has been (partially) extracted, thus the
+                        # destination cannot be trusted anymore.
+                        raise DownloadError(
+                            f'could not extract {filename}, '
+                            f'{destination} is corrupted'
+                        ) from e
+                raise
+
+            if self.cache_dir is not None:
+                os.replace(path, cached)
+                return None if stream else (cached, False)
             else:
-                return
+                return None if stream else (path, True)
 
-        extractor = None
         with tempfile.TemporaryDirectory() as tmpdir:
             workdir = Path(tmpdir)
-            for _ in fetch_layers():
-                if extractor is None:
+            layers = manifest['layers']
+            max_workers = min(MAX_WORKERS, len(layers)) or 1
+            try:
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    futures = [executor.submit(fetch_layer, index, layer)
+                               for (index, layer) in enumerate(layers)]
                     try:
-                        filename = tarfiles.popleft()
-                    except IndexError:
-                        continue
-                    else:
-                        extractor = TarExtractor(
-                            filename = workdir / filename,
-                            destination = destination,
-                            clean = True
-                        )
-                        print(f'extracting {filename}')
-                else:
-                    if extractor.done():
-                        extractor = None
-            else:
-                if extractor:
-                    extractor.extract()
+                        for future in futures:
+                            result = future.result()
+                            if result is not None:
+                                path, clean = result
+                                extractor = TarExtractor(
+                                    filename = path,
+                                    destination = destination,
+                                    clean = clean
+                                )
+                                print(f'extracting {path.name}')
+                                extractor.extract()
+                            extracted += 1
+                    except Exception:
+                        for future in futures:
+                            future.cancel()
+                        raise
+            finally:
+                # Worker threads are done, thus close their sessions.
+                with self._lock:
+                    for session in workers:
+                        session.close()
+                        if session in self.sessions:
+                            self.sessions.remove(session)
 
-                while tarfiles:
-                    filename = tarfiles.popleft()
-                    extractor = TarExtractor(
-                        filename = filename,
-                        destination = destination,
-                        clean = True
-                    )
-                    print(f'extracting {filename}')
-                    extractor.extract()
+        # Make extracted files readable and writable (by the owner). This is
+        # done once, after all layers have been extracted (directories are
+        # already made writable after each layer, see TarExtractor).
+        cmd = ['chmod', 'u+rw', '-R', str(destination)]
+        result = subprocess.run(cmd, capture_output=True)
+        if result.stderr:
+            raise TarError(result.stderr.decode())
 
 
 @dataclass(frozen=True)
 class TarExtractor:
-    '''A tar file extractor running as a suprocess, for parallelisation.'''
+    '''A tar file extractor running as a suprocess, for parallelisation.
+
+       If no filename is provided, then data are fed using the write method.
+    '''
 
-    filename: Path
+    filename: Optional[Path]
     destination: str
     clean: bool = False
 
     process: subprocess.Popen = field(init=False)
 
+    log: IO[bytes] = field(init=False)
+
     def __post_init__(self):
-        cmd = ' && '.join((
-            f'mkdir -p {self.destination}',
-            f'tar -xzf {self.filename} -C {self.destination}',
-            f'chmod u+rw -R {self.destination}'
-        ))
+        Path(self.destination).mkdir(parents=True, exist_ok=True)
+        cmd = ['tar', '--no-same-permissions', '--no-same-owner']
+        # Use pigz for decompressing, if available.
+        if shutil.which('pigz'):
+            cmd += ['--use-compress-program=pigz', '-xf']
+        else:
+            cmd += ['-xzf']
+        if self.filename is None:
+            cmd += ['-', '-C', str(self.destination)]
+            stdin = subprocess.PIPE
+        else:
+            cmd += [str(self.filename), '-C', str(self.destination)]
+            stdin = None
+        # tar's stderr is redirected to a file, since nothing reads it while
+        # data are being written to tar's stdin (which could otherwise block
+        # tar once the pipe buffer is full).
+        log = tempfile.TemporaryFile()
         process = subprocess.Popen(
             cmd,
-            stdout = subprocess.PIPE,
-            stderr = subprocess.PIPE,
-            shell = True
+            stdin = stdin,
+            stdout = subprocess.DEVNULL,
+            stderr = log
         )
         object.__setattr__(self, 'process', process)
+        object.__setattr__(self, 'log', log)
+
+    def write(self, data: bytes):
+        try:
+            self.process.stdin.write(data)
+        except BrokenPipeError:
+            pass # tar exited, errors are reported by the extract method.
+
+    def abort(self):
+        '''Terminate the extraction, e.g. in case of error.'''
+        if self.process.stdin is not None:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+        self.process.kill()
+        self.process.wait()
+        self.log.close()
 
     def extract(self):
-        _, err = self.process.communicate()
-        if self.clean:
+        self.process.communicate()
+        with self.log:
+            self.log.seek(0)
+            err = self.log.read()
+        if self.clean and (self.filename is not None):
             self.filename.unlink()
         if err:
             raise TarError(err.decode())
 
-    def done(self) -> bool:
-        if self.process.poll() is None:
-            return False
-        else:
-            self.extract()
-            return True
+        # Directories might be read-only (e.g. /root), which would prevent
+        # extracting next layers. Thus, these are made writable (for the owner).
+        cmd = ['find', str(self.destination), '-type', 'd', '!', '-perm',
+               '-u+w', '-exec', 'chmod', 'u+w', '{}', '+']
+        result = subprocess.run(cmd, capture_output=True)
+        if result.returncode != 0:
+            raise TarError(result.stderr.decode())
@@ -1,5 +1,8 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from enum import auto, Enum
+import functools
 import glob
 import os
 import re
@@ -7,7 +10,133 @@ from pathlib import Path
 import shutil
 import stat
 import subprocess
-from typing import Dict, List, NamedTuple, Optional, Union
+import tempfile
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Sequence, \
+                   Union
+
+try:
+    from elftools.elf.elffile import ELFFile
+except ImportError:
+    ELFFile = None
+
+
+COPY_WORKERS = 32
+
+NEEDED_PATTERN = re.compile(
+    rb'[(]NEEDED[)]\s+Shared library:\s+\[([^\]]+)\]'
+)
+
+
+def _copy_file(src: Path, dst: Path, mode: int=0):
+    '''Copy a file content and permissions, using a zero-copy transfer.
+
+       Symbolic links are followed. Additional permission bits can be set on the
+       destination file using the *mode* argument.
+    '''
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        st = os.fstat(infd)
+        offset = 0
+        while offset < st.st_size:
+            sent = os.sendfile(outfd, infd, offset, st.st_size - offset)
+            if sent == 0:
+                break
+            offset += sent
+        os.fchmod(outfd, stat.S_IMODE(st.st_mode) | mode)
+
+
+def _copy_tree(src: Path, dst: Path):
+    '''Copy a directory tree, preserving symbolic links.
+
+       The copy is delegated to `cp` (using reflinks, if supported by the file
+       system) or to a pair of piped `tar`. As a last resort, files are copied
+       from Python using a pool of threads, in order to overlap file system
+       calls. Existing destination files are replaced, even if read-only.
+    '''
+    dst.mkdir(parents=True, exist_ok=True)
+    errors = []
+
+    try:
+        cmd = ['cp', '-R', '-P', '-f', '--preserve=mode,timestamps',
+               '--reflink=auto', f'{src}/.', f'{dst}/']
+        result = subprocess.run(cmd, capture_output=True)
+    except FileNotFoundError as e:
+        errors.append(str(e))
+    else:
+        if result.returncode == 0:
+            return
+        else:
+            errors.append(result.stderr.decode())
+
+    try:
+        log = tempfile.TemporaryFile()
+        with log:
+            archiver = subprocess.Popen(
+                ['tar', '-C', str(src), '-cf', '-', '.'],
+                stdout=subprocess.PIPE,
+                stderr=log
+            )
+            extractor = subprocess.run(
+                ['tar', '--no-same-owner', '-C', str(dst), '-xf', '-'],
+                stdin=archiver.stdout,
+                capture_output=True
+            )
+            archiver.stdout.close()
+            if (archiver.wait() == 0) and (extractor.returncode == 0):
+                return
+            else:
+                log.seek(0)
+                errors.append(log.read().decode() +
+                              extractor.stderr.decode())
+    except FileNotFoundError as e:
+        errors.append(str(e))
+
+    def copy_entry(item):
+        source, target = item
+        if os.path.islink(source):
+            if os.path.lexists(target):
+                os.unlink(target)
+            os.symlink(os.readlink(source), target)
+        else:
+            try:
+                shutil.copyfile(source, target)
+            except PermissionError:
+                # The target might be read-only, thus replace it.
+                if not os.path.lexists(target):
+                    raise
+                os.unlink(target)
+                shutil.copyfile(source, target)
+            shutil.copystat(source, target)
+
+    directories, entries = [], []
+    for (dirpath, dirnames, filenames) in os.walk(src):
+        # Directories are walked top-down, thus parents already exist.
+        target = dst / os.path.relpath(dirpath, src)
+        target.mkdir(exist_ok=True)
+        directories.append((dirpath, target))
+        for name in dirnames:
+            source = os.path.join(dirpath, name)
+            if os.path.islink(source):
+                entries.append((source, target / name))
+        for name in filenames:
+            entries.append((os.path.join(dirpath, name), target / name))
+
+    try:
+        with ThreadPoolExecutor(max_workers=COPY_WORKERS) as executor:
+            for _ in executor.map(copy_entry, entries):
+                pass
+
+        # Directories permissions are mirrored last, since some might be
+        # read-only.
+        for (source, target) in directories:
+            shutil.copystat(source, target)
+    except Exception as e:
+        if errors:
+            # Report failures of external tools as well.
+            message = '\n'.join(errors)
+            raise OSError(f'could not copy {src} to {dst}\n{message}') from e
+        else:
+            raise
 
 
 class Arch(Enum):
@@ -31,12 +160,11 @@ class PythonVersion(NamedTuple):
     patch: Union[int, str]
 
     @classmethod
+    @functools.lru_cache(maxsize=32)
     def from_str(cls, value: str) -> 'PythonVersion':
         major, minor, patch = value.split('.', 2)
-        try:
+        if patch.isdecimal():
             patch = int(patch)
-        except ValueError:
-            pass
         return cls(int(major), int(minor), patch)
 
     def long(self) -> str:
@@ -67,8 +195,8 @@ class Extractor:
     '''Patchelf executable.'''
 
 
+    excluded: FrozenSet[str] = field(init=False)
     '''Excluded shared libraries.'''
-    excluded: List[str] = field(init=False)
 
     impl: PythonImpl = field(init=False)
     '''Python implementation'''
@@ -82,6 +210,9 @@ class Extractor:
     version: PythonVersion = field(init=False)
     '''Python version'''
 
+    _libraries: Dict[str, Path] = field(init=False, repr=False, compare=False)
+    '''Index of available libraries, by name'''
+
 
     def __post_init__(self):
         # Locate Python installation.
@@ -116,16 +247,30 @@ class Extractor:
 
         object.__setattr__(self, 'library_path', paths)
 
+        # Index available libraries, scanning the search path once. In case of
+        # name collisions, the first match (in search order) prevails.
+        libraries = dict()
+        for dirname in paths:
+            try:
+                entries = os.scandir(dirname)
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    if (entry.name not in libraries) and entry.is_file():
+                        libraries[entry.name] = dirname / entry.name
+        object.__setattr__(self, '_libraries', libraries)
+
         # Set excluded libraries.
         excludelist = Path(self.excludelist) if self.excludelist \
                       else Path(__file__).parent / 'share/excludelist'
-        excluded = []
+        excluded = set()
         with excludelist.open() as f:
             for line in f:
                 line = line.strip()
                 if line and not line.startswith('#'):
-                    excluded.append(line)
-        object.__setattr__(self, 'excluded', excluded)
+                    excluded.add(line)
+        object.__setattr__(self, 'excluded', frozenset(excluded))
 
         # Set patchelf, if not provided.
         if self.patchelf is None:
@@ -172,60 +317,79 @@ class Extractor:
         short.symlink_to(f'python{self.version.major}')
 
         for folder in (packages, include):
-            # XXX Some files are read-only, which prevents overriding the
-            # destination in case that a second copy occurs. A workaround would
-            # be to copy the files content but changing their permissions.
-            # However, there don't seem to be a function for this use case in
-            # shutil (i.e. doing so recusively, for directories).
-            shutil.copytree(self.python_prefix / folder, destination / folder,
-                            symlinks=True, dirs_exist_ok=True)
-
-        # Map binary dependencies.
-        libs = self.ldd(self.python_prefix / f'bin/{python}')
-        path = Path(self.python_prefix / f'{packages}/lib-dynload')
-        for module in glob.glob(str(path / "*.so")):
-            l = self.ldd(module)
-            libs.update(l)
-
-        # Copy and patch binary dependencies.
+            # Some files are read-only. Thus, in case that a second copy
+            # occurs, existing destination files are replaced rather than
+            # overwritten (see _copy_tree).
+            _copy_tree(self.python_prefix / folder, destination / folder)
+
+        # Map and copy binary dependencies. Note that the work is mostly done
+        # by external processes (readelf). Thus, threads are used in order to
+        # run these in parallel.
         libdir = destination / 'lib'
-        for (name, src) in libs.items():
+
+        def copy_library(item):
+            name, src = item
             dst = libdir / name
-            shutil.copy(src, dst, follow_symlinks=True)
             # As stated previously, some libraries are read-only, which prevents
-            # overriding the destination directory. Below, we change the
-            # permission of destination files to read-write (for the owner).
-            mode = dst.stat().st_mode
-            if not (mode & stat.S_IWUSR):
-                mode = mode | stat.S_IWUSR
-                dst.chmod(mode)
-
-            self.set_rpath(dst, '$ORIGIN')
-
-        # Patch RPATHs of binary modules.
-        path = Path(destination / f'{packages}/lib-dynload')
-        for module in glob.glob(str(path / "*.so")):
-            src = Path(module)
-            dst = os.path.relpath(libdir, src.parent)
-            self.set_rpath(src, f'$ORIGIN/{dst}')
-
-        # Patch RPATHs of Python runtime.
+            # overriding the destination directory. Thus, the permission of
+            # destination files is set to read-write (for the owner).
+            _copy_file(src, dst, stat.S_IWUSR)
+            return dst
+
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            # Map binary dependencies.
+            libs = self.ldd(self.python_prefix / f'bin/{python}')
+            dynload = f'{packages}/lib-dynload'
+            with os.scandir(self.python_prefix / dynload) as entries:
+                modules = [entry.name for entry in entries
+                           if entry.name.endswith('.so')]
+            paths = (self.python_prefix / dynload / name for name in modules)
+            for l in executor.map(self.ldd, paths):
+                libs.update(l)
+
+            # Copy binary dependencies.
+            libraries = list(executor.map(copy_library, libs.items()))
+
+        # Patch RPATHs of binary dependencies, of binary modules and of the
+        # Python runtime. Targets are grouped by RPATH, such that patchelf is
+        # run only once per group.
+        rpaths = collections.defaultdict(list)
+        rpaths['$ORIGIN'] += libraries
+
+        path = destination / dynload
+        dst = os.path.relpath(libdir, path)
+        rpaths[f'$ORIGIN/{dst}'] += [path / name for name in modules]
+
         src = destination / runtime
         dst = os.path.relpath(libdir, src.parent)
-        self.set_rpath(src, f'$ORIGIN/{dst}')
+        rpaths[f'$ORIGIN/{dst}'].append(src)
+
+        for (rpath, targets) in rpaths.items():
+            self.set_rpath(targets, rpath)
 
 
     def ldd(self, target: Path) -> Dict[str, Path]:
-        '''Cross-platform implementation of ldd, using readelf.'''
+        '''Cross-platform implementation of ldd, using pyelftools or readelf.'''
 
-        pattern = re.compile(r'[(]NEEDED[)]\s+Shared library:\s+\[([^\]]+)\]')
         dependencies = dict()
 
+        def needed(target: Path) -> List[str]:
+            if ELFFile is None:
+                result = subprocess.run(['readelf', '-d', str(target)],
+                                        check=True, capture_output=True)
+                return [match.decode() for match in
+                        NEEDED_PATTERN.findall(result.stdout)]
+            else:
+                with open(target, 'rb') as f:
+                    dynamic = ELFFile(f).get_section_by_name('.dynamic')
+                    if dynamic is None:
+                        return []
+                    else:
+                        return [tag.needed for tag in
+                                dynamic.iter_tags('DT_NEEDED')]
+
         def recurse(target: Path):
-            result = subprocess.run(f'readelf -d {target}', shell=True,
-                                    check=True, capture_output=True)
-            stdout = result.stdout.decode()
-            matches = pattern.findall(stdout)
+            matches = needed(target)
 
             for match in matches:
                 if (match not in dependencies) and (match not in self.excluded):
@@ -240,19 +404,24 @@ class Extractor:
     def locate_library(self, name: str) -> Path:
         '''Locate a library given its qualified name.'''
 
-        for dirname in self.library_path:
-            path = dirname / name
-            if path.exists():
-                return path
-        else:
-            raise FileNotFoundError(name)
-
-
-    def set_rpath(self, target, rpath):
-        cmd = f'{self.patchelf} --print-rpath {target}'
-        result = subprocess.run(cmd, shell=True, check=True,
-                                capture_output=True)
-        current_rpath = result.stdout.decode().strip()
-        if current_rpath != rpath:
-            cmd = f"{self.patchelf} --set-rpath '{rpath}' {target}"
-            subprocess.run(cmd, shell=True, check=True, capture_output=True)
+        try:
+            return self._libraries[name]
+        except KeyError:
+            raise FileNotFoundError(name) from None
+
+
+    def set_rpath(self, targets: Union[Path, Sequence[Path]], rpath: str):
+        '''Set the RPATH of one or more binaries.'''
+
+        if isinstance(targets, (str, Path)):
+            targets = (targets,)
+        if not targets:
+            return
+        # The rpath is set unconditionally, without reading it back first.
+        # Note that patchelf converts DT_RPATH entries to DT_RUNPATH ones
+        # (unless --force-rpath is used). Thus, binaries carrying a DT_RPATH
+        # entry are rewritten, even if their rpath already has the expected
+        # value.
+        cmd = [str(self.patchelf), '--set-rpath', rpath,
+               *(str(target) for target in targets)]
+        subprocess.run(cmd, check=True, capture_output=True)